@@ -0,0 +1,217 @@
+import json
+import os
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Tuple, Any
+
+import pandas as pd
+
+from bodyport.load import DataWarehouseManager
+from bodyport.orm import Run, RunFeature
+
+
+# Run columns that identify and track runs: dedup, checkpointing and reconciliation rely on them
+PROTECTED_COLUMNS = {'id', 'subject_id', 'run_hash', 'raw_path', 'meta_path', 'created_at', 'updated_at'}
+
+
+class FeatureFunction:
+    """
+    A per-run feature registered with `register_feature`.
+
+    `func` receives the run's raw data and its header metadata, i.e. `func(run.raw, run.meta)`,
+    and returns a JSON-serializable value (numpy scalars/arrays are converted).
+    It must be defined at module level so it can be sent to worker processes.
+
+    If `column` is set, the result is also written to that column of every `Run` with the same run_hash.
+    It can't be one of the PROTECTED_COLUMNS.
+    """
+
+    def __init__(self, name: str, func: Callable[[pd.DataFrame, Dict], Any], column: Optional[str] = None):
+        if column is not None and column not in Run.__table__.columns:
+            raise ValueError(f"Run has no column named {column!r}")
+        if column in PROTECTED_COLUMNS:
+            raise ValueError(f"Run.{column} can't hold feature results, it is one of {sorted(PROTECTED_COLUMNS)}")
+
+        self.name = name
+        self.func = func
+        self.column = column
+
+    def __repr__(self):
+        return f"FeatureFunction<name={self.name}, column: {self.column}>"
+
+
+# all registered features, by name
+FEATURES: Dict[str, FeatureFunction] = {}
+
+
+def register_feature(name: Optional[str] = None, column: Optional[str] = None):
+    """
+    Decorator registering a per-run feature function, e.g.
+
+        @register_feature(column='avg_bpm')
+        def avg_bpm(raw: pd.DataFrame, meta: Dict) -> float:
+            ...
+    """
+    def decorator(func):
+        feature_name = name or func.__name__
+        FEATURES[feature_name] = FeatureFunction(name=feature_name, func=func, column=column)
+        return func
+
+    return decorator
+
+
+def compute_chunk(func: Callable, runs: List[Tuple[str, str, str]]) -> List[Tuple[str, Any]]:
+    """
+    Runs in a worker process: compute `func` for each (run_hash, raw_path, meta_path).
+
+    Raw files are read here rather than in the parent, so only paths and results cross process boundaries.
+    """
+    results = []
+    for run_hash, raw_path, meta_path in runs:
+        with open(meta_path, 'r') as f:
+            meta = json.load(f)
+        value = func(pd.read_csv(raw_path), meta)
+        # numpy scalars and arrays aren't JSON serializable
+        if hasattr(value, 'tolist'):
+            value = value.tolist()
+        results.append((run_hash, value))
+    return results
+
+
+class FeatureJobRunner:
+    """
+    Backfill a registered feature for all runs in the Data Warehouse on a process pool.
+
+    Runs are fanned out in chunks, and each finished chunk is written in bulk and committed on its own.
+    Because results are keyed by run_hash in `run_feature`, a re-run skips every run that was already
+    computed: an interrupted backfill resumes where it left off, and unchanged runs are never redone.
+    A new run whose raw file was already computed under another run gets the stored result copied over.
+    """
+
+    def __init__(self, data_warehouse: DataWarehouseManager, max_workers: Optional[int] = None,
+                 chunk_size: int = 20):
+        self.data_warehouse = data_warehouse
+        self.db_session = data_warehouse.db_session
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.chunk_size = chunk_size
+
+    def run(self, name: str, recompute: bool = False) -> int:
+        """
+        Compute feature `name` for every run that doesn't have it yet.
+
+        :param name: name of a registered feature
+        :param recompute: ignore existing results and compute everything again
+        :return: number of distinct run_hashes computed, not counting stored results copied to new runs
+        """
+        if name not in FEATURES:
+            raise ValueError(f"No feature registered as {name!r}, choose from {sorted(FEATURES)}")
+        feature = FEATURES[name]
+
+        if recompute:
+            self.db_session.query(RunFeature).filter_by(name=name).delete()
+            self.db_session.commit()
+
+        pending = self.find_pending_runs(name)
+        chunks = [pending[i:i + self.chunk_size] for i in range(0, len(pending), self.chunk_size)]
+
+        # the Run rows each hash maps to, for column writes and the subject_features refresh
+        runs_by_hash = defaultdict(list)
+        for run_id, subject_id, run_hash in self.db_session.query(Run.id, Run.subject_id, Run.run_hash):
+            runs_by_hash[run_hash].append((run_id, subject_id))
+
+        with ProcessPoolExecutor(max_workers=self.max_workers) as executor:
+            # only keep a few chunks in flight so memory doesn't grow with the number of runs
+            max_in_flight = 2 * self.max_workers
+            chunks = iter(chunks)
+            in_flight = set()
+
+            try:
+                while True:
+                    for chunk in chunks:
+                        in_flight.add(executor.submit(compute_chunk, feature.func, chunk))
+                        if len(in_flight) >= max_in_flight:
+                            break
+
+                    if not in_flight:
+                        break
+
+                    done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        self.save_results(feature, future.result(), runs_by_hash)
+            except BaseException:
+                for future in in_flight:
+                    future.cancel()
+                self.db_session.rollback()
+                raise
+
+        if feature.column is not None:
+            self.copy_stored_results(feature)
+
+        return len(pending)
+
+    def find_pending_runs(self, name: str) -> List[Tuple[str, str, str]]:
+        """(run_hash, raw_path, meta_path) of one run per run_hash that has no result for `name` yet"""
+        computed = self.db_session.query(RunFeature.run_hash).filter_by(name=name)
+
+        pending = {}
+        for run_hash, raw_path, meta_path in self.db_session.query(
+            Run.run_hash, Run.raw_path, Run.meta_path
+        ).filter(Run.run_hash.notin_(computed)):
+            pending.setdefault(run_hash, (run_hash, raw_path, meta_path))
+
+        return list(pending.values())
+
+    def save_results(self, feature: FeatureFunction, results: List[Tuple[str, Any]], runs_by_hash: Dict):
+        """Bulk write one chunk of results, committing it as the checkpoint for those runs"""
+        timestamp = datetime.now()
+
+        self.db_session.bulk_insert_mappings(RunFeature, [
+            dict(run_hash=run_hash, name=feature.name, value=value, created_at=timestamp)
+            for run_hash, value in results
+        ])
+
+        if feature.column is None:
+            self.db_session.commit()
+            return
+
+        self.write_column(feature, results, runs_by_hash, timestamp=timestamp)
+
+    def copy_stored_results(self, feature: FeatureFunction):
+        """
+        Fill `feature.column` of runs that don't have it, but whose run_hash already has a result.
+
+        This happens when a raw file identical to an already computed one is loaded under another subject:
+        its hash isn't pending, yet the new Run row has never been written to.
+        """
+        column = getattr(Run, feature.column)
+        uncopied = self.db_session.query(Run.id, Run.subject_id, Run.run_hash, RunFeature.value).join(
+            RunFeature, (RunFeature.run_hash == Run.run_hash) & (RunFeature.name == feature.name)
+        ).filter(column.is_(None))
+
+        runs_by_hash = defaultdict(list)
+        values = {}
+        for run_id, subject_id, run_hash, value in uncopied:
+            runs_by_hash[run_hash].append((run_id, subject_id))
+            values[run_hash] = value
+
+        if values:
+            self.write_column(feature, list(values.items()), runs_by_hash, timestamp=datetime.now())
+
+    def write_column(self, feature: FeatureFunction, results: List[Tuple[str, Any]], runs_by_hash: Dict,
+                     timestamp: datetime):
+        """Bulk write results to `feature.column` of the runs with those hashes, and refresh their subjects"""
+        self.db_session.bulk_update_mappings(Run, [
+            {'id': run_id, feature.column: value, 'updated_at': timestamp}
+            for run_hash, value in results
+            for run_id, _ in runs_by_hash[run_hash]
+        ])
+
+        affected_subject_ids = {
+            subject_id
+            for run_hash, _ in results
+            for _, subject_id in runs_by_hash[run_hash]
+        }
+        # keep the per-subject summaries in step with the backfilled column.
+        # this also commits, so results, column and summaries are checkpointed together
+        self.data_warehouse.refresh_subject_features(subject_ids=affected_subject_ids, timestamp=timestamp)
@@ -1,12 +1,31 @@
+import asyncio
 import hashlib
+import itertools
 import json
+import math
 from datetime import datetime, date
 from pathlib import Path
-from typing import List, Dict
+from concurrent.futures import Executor
+from contextlib import nullcontext
+from typing import Any, Callable, List, Dict, Optional, Iterable, Set
 
 import pandas as pd
+from sqlalchemy import func, or_
 
-from bodyport.orm import Base, Subject, Run, create_session
+from bodyport.orm import Base, Subject, Run, SubjectFeatures, create_session
+from bodyport.profiling import MemoryProfiler
+
+# stay well under sqlite's limit on bound parameters in an IN (...) clause
+MAX_SQL_VARIABLES = 500
+
+# characters read at a time when hashing raw files, so a file is never held in memory whole
+HASH_CHUNK_SIZE = 1 << 14
+
+# run paths crawled per trip to the thread pool during asyncio discovery
+DISCOVERY_CHUNK_SIZE = 64
+
+# Run rows fetched from the DB at a time by map_raw
+RAW_READ_BATCH_SIZE = 100
 
 
 class DataWarehouseManager:
@@ -16,10 +35,13 @@ class DataWarehouseManager:
 
     """
 
-    def __init__(self, db_conn_string=None):
+    def __init__(self, db_conn_string=None, memory_profiler: Optional[MemoryProfiler] = None):
         self.data_dir = None
         self.current_time = None
 
+        # when set, each stage of load() is profiled, see memory_profiler.report()
+        self.memory_profiler = memory_profiler
+
         self.db_session = create_session(db_conn_string=db_conn_string)
 
         # get path to database
@@ -41,6 +63,12 @@ class DataWarehouseManager:
         self.down()
         self.up()
 
+    def profile(self, stage: str):
+        """Context manager profiling the given stage if a memory_profiler was given, a no-op otherwise"""
+        if self.memory_profiler is None:
+            return nullcontext()
+        return self.memory_profiler.stage(stage, session=self.db_session)
+
     def load(self, data_dir: Path):
         """
         process the given data directory,
@@ -58,8 +86,121 @@ class DataWarehouseManager:
 
         self.data_dir = data_dir
 
-        self.update_runs(timestamp=current_time)
-        self.update_subjects(timestamp=current_time)
+        # warehouses created before subject_features existed get it here, before anything is committed
+        self.up()
+
+        with self.profile('update_runs'):
+            self.update_runs(timestamp=current_time)
+        with self.profile('update_subjects'):
+            self.update_subjects(timestamp=current_time)
+        with self.profile('refresh_subject_features'):
+            self.refresh_subject_features(subject_ids=self.find_stale_subject_ids(), timestamp=current_time)
+
+    async def aload(self, data_dir: Path, executor: Optional[Executor] = None,
+                    n_parsers: int = 4, queue_size: int = 64, batch_size: int = 100):
+        """
+        asyncio variant of `load()`, so that I/O wait on one file doesn't block the others.
+
+        The load is split into 3 stages connected by bounded queues:
+
+            discovery -> read/hash/parse (x n_parsers) -> single DB writer
+
+        Because the queues are bounded, a slow stage pushes back on the ones before it, and
+        at most ~2 * queue_size runs are held in memory regardless of how big data_dir is.
+
+        Reading, hashing and parsing run files is offloaded to `executor` (the loop's default thread pool
+        if None). Since only run paths go in and `Run` objects come out, a ProcessPoolExecutor works too.
+        Crawling always happens on the default thread pool, as the glob generator can't leave this process.
+        All DB work stays on the event loop thread: sqlite connections are tied to the thread
+        that created them, and a single writer avoids lock contention anyway.
+
+        Since this is a coroutine it can be awaited directly in a notebook, where a loop is already
+        running (`await dw.aload(data_dir)`); from a script use `asyncio.run(dw.aload(data_dir))`.
+        """
+        current_time = datetime.now()
+
+        self.data_dir = data_dir
+
+        # warehouses created before subject_features existed get it here, before anything is committed
+        self.up()
+
+        paths = asyncio.Queue(maxsize=queue_size)
+        runs = asyncio.Queue(maxsize=queue_size)
+
+        parsers = [
+            asyncio.ensure_future(self._parse_stage(paths, runs, executor))
+            for _ in range(n_parsers)
+        ]
+        tasks = [
+            asyncio.ensure_future(self._discovery_stage(paths, n_parsers)),
+            asyncio.ensure_future(self._writer_stage(runs, n_parsers, current_time, batch_size)),
+            *parsers
+        ]
+
+        try:
+            with self.profile('aload_pipeline'):
+                await asyncio.gather(*tasks)
+        except BaseException:
+            # don't leave the other stages blocked on a queue that will never drain
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            self.db_session.rollback()
+            raise
+
+        with self.profile('update_subjects'):
+            self.update_subjects(timestamp=current_time)
+        with self.profile('refresh_subject_features'):
+            self.refresh_subject_features(subject_ids=self.find_stale_subject_ids(), timestamp=current_time)
+
+    ##############
+    # asyncio pipeline stages
+    ##############
+    async def _discovery_stage(self, paths: asyncio.Queue, n_parsers: int):
+        loop = asyncio.get_running_loop()
+        run_paths = iter(self.find_run_paths())
+
+        while True:
+            # globbing touches the filesystem too, so step the generator off the loop a chunk at a time
+            chunk = await loop.run_in_executor(None, list, itertools.islice(run_paths, DISCOVERY_CHUNK_SIZE))
+            if not chunk:
+                break
+            for run_path in chunk:
+                await paths.put(run_path)
+
+        # one sentinel per parser
+        for _ in range(n_parsers):
+            await paths.put(None)
+
+    async def _parse_stage(self, paths: asyncio.Queue, runs: asyncio.Queue, executor: Optional[Executor]):
+        loop = asyncio.get_running_loop()
+
+        while True:
+            run_path = await paths.get()
+            if run_path is None:
+                break
+            maybe_new_run = await loop.run_in_executor(executor, self.generate_run_from_path, run_path)
+            await runs.put(maybe_new_run)
+
+        await runs.put(None)
+
+    async def _writer_stage(self, runs: asyncio.Queue, n_parsers: int, timestamp: datetime, batch_size: int):
+        batch = []
+        n_finished_parsers = 0
+
+        while n_finished_parsers < n_parsers:
+            maybe_new_run = await runs.get()
+            if maybe_new_run is None:
+                n_finished_parsers += 1
+                continue
+
+            batch.append(maybe_new_run)
+            if len(batch) >= batch_size:
+                self.insert_new_runs(batch, timestamp=timestamp)
+                batch = []
+
+        if batch:
+            self.insert_new_runs(batch, timestamp=timestamp)
 
     ##############
     # DB reconciliation and inserts
@@ -78,6 +219,27 @@ class DataWarehouseManager:
                 self.db_session.add(maybe_new_run)
                 self.db_session.commit()
 
+    def insert_new_runs(self, maybe_new_runs: List[Run], timestamp: datetime):
+        """
+        Batched version of the reconciliation in `update_runs`:
+        one lookup and one commit for the whole batch instead of per run.
+        """
+        hashes = {run.run_hash for run in maybe_new_runs}
+        seen = set(
+            self.db_session.query(Run.subject_id, Run.run_hash).filter(Run.run_hash.in_(hashes))
+        )
+
+        for maybe_new_run in maybe_new_runs:
+            key = (maybe_new_run.subject_id, maybe_new_run.run_hash)
+            # also catches duplicates within the batch itself
+            if key in seen:
+                continue
+            seen.add(key)
+            maybe_new_run.created_at = timestamp
+            self.db_session.add(maybe_new_run)
+
+        self.db_session.commit()
+
     def update_subjects(self, timestamp: datetime):
 
         # crawl subject_id's for all runs
@@ -100,6 +262,111 @@ class DataWarehouseManager:
                 self.db_session.add(new_subject)
                 self.db_session.commit()
 
+    def find_stale_subject_ids(self) -> Set[int]:
+        """
+        Subjects whose `subject_features` row is missing, or older than one of their runs or their subject row.
+
+        Runs are committed as they are loaded, but features are only refreshed at the end of a load.
+        Deriving the affected subjects from the DB rather than from the runs inserted by this load
+        means a load that failed partway is caught up by the next one. Subject rows count too: features
+        refreshed by a backfill before the subject row existed have no sex/birth_year yet.
+        """
+        stale = self.db_session.query(Run.subject_id).outerjoin(
+            SubjectFeatures, SubjectFeatures.subject_id == Run.subject_id
+        ).outerjoin(
+            Subject, Subject.id == Run.subject_id
+        ).filter(or_(
+            SubjectFeatures.subject_id.is_(None),
+            Run.created_at > SubjectFeatures.updated_at,
+            Run.updated_at > SubjectFeatures.updated_at,
+            Subject.created_at > SubjectFeatures.updated_at,
+            Subject.updated_at > SubjectFeatures.updated_at
+        )).distinct()
+        return {subject_id for subject_id, in stale}
+
+    def refresh_subject_features(self, subject_ids: Optional[Iterable[int]] = None,
+                                 timestamp: Optional[datetime] = None):
+        """
+        Recompute the `subject_features` rows of the given subjects from their runs.
+
+        Only the affected subjects are touched, so after an incremental load or a feature backfill
+        this costs a GROUP BY over those subjects' runs rather than over the whole `run` table.
+
+        :param subject_ids: subjects whose runs changed. None means rebuild every subject.
+        :param timestamp: created_at/updated_at for the rows written, defaults to now
+        """
+        timestamp = timestamp or datetime.now()
+
+        if subject_ids is None:
+            subject_ids = {subject_id for subject_id, in self.db_session.query(Run.subject_id).distinct()}
+            # also drop features of subjects that no longer have any runs
+            subject_ids |= {subject_id for subject_id, in self.db_session.query(SubjectFeatures.subject_id)}
+
+        subject_ids = sorted(set(subject_ids))
+
+        for i in range(0, len(subject_ids), MAX_SQL_VARIABLES):
+            self._refresh_subject_features_chunk(subject_ids[i:i + MAX_SQL_VARIABLES], timestamp=timestamp)
+
+        self.db_session.commit()
+
+    def _refresh_subject_features_chunk(self, subject_ids: List[int], timestamp: datetime):
+        run_stats = self.db_session.query(
+            Run.subject_id,
+            func.count(Run.id).label('n_runs'),
+            func.min(Run.date).label('first_run_date'),
+            func.max(Run.date).label('last_run_date'),
+            func.count(Run.avg_bpm).label('n_runs_with_bpm'),
+            func.avg(Run.avg_bpm).label('mean_avg_bpm'),
+            # sqlite has no STDDEV, so derive it from the mean of squares
+            func.avg(Run.avg_bpm * Run.avg_bpm).label('mean_sq_avg_bpm'),
+            func.min(Run.avg_bpm).label('min_avg_bpm'),
+            func.max(Run.avg_bpm).label('max_avg_bpm')
+        ).filter(Run.subject_id.in_(subject_ids)).group_by(Run.subject_id)
+        run_stats = {row.subject_id: row for row in run_stats}
+
+        subjects = self.db_session.query(Subject).filter(Subject.id.in_(subject_ids))
+        subjects = {subject.id: subject for subject in subjects}
+
+        existing = self.db_session.query(SubjectFeatures).filter(SubjectFeatures.subject_id.in_(subject_ids))
+        existing = {features.subject_id: features for features in existing}
+
+        for subject_id in subject_ids:
+            features = existing.get(subject_id)
+            stats = run_stats.get(subject_id)
+
+            if stats is None:
+                if features is not None:
+                    self.db_session.delete(features)
+                continue
+
+            if features is None:
+                features = SubjectFeatures(subject_id=subject_id, created_at=timestamp)
+                self.db_session.add(features)
+
+            subject = subjects.get(subject_id)
+            features.sex = subject.sex if subject else None
+            features.birth_year = subject.birth_year if subject else None
+            features.n_runs = stats.n_runs
+            features.first_run_date = stats.first_run_date
+            features.last_run_date = stats.last_run_date
+            features.n_runs_with_bpm = stats.n_runs_with_bpm
+            features.mean_avg_bpm = stats.mean_avg_bpm
+            features.std_avg_bpm = self.sample_std(
+                n=stats.n_runs_with_bpm, mean=stats.mean_avg_bpm, mean_sq=stats.mean_sq_avg_bpm
+            )
+            features.min_avg_bpm = stats.min_avg_bpm
+            features.max_avg_bpm = stats.max_avg_bpm
+            features.updated_at = timestamp
+
+    @staticmethod
+    def sample_std(n: int, mean: Optional[float], mean_sq: Optional[float]) -> Optional[float]:
+        """Sample standard deviation (ddof=1, like pandas) from the count, mean and mean of squares"""
+        if n < 2:
+            return None
+        variance = (mean_sq - mean ** 2) * n / (n - 1)
+        # guard against tiny negative values from floating point cancellation
+        return math.sqrt(max(variance, 0.0))
+
     ##############################
     # Filesystem Crawler Methods
     ##############################
@@ -130,6 +397,19 @@ class DataWarehouseManager:
     def pandas_query(self, query):
         return pd.read_sql(query, con=self.db_session.bind)
 
+    def map_raw(self, raw_func: Callable[[pd.DataFrame], Any], runs: Optional[Iterable[Run]] = None) -> List:
+        """
+        Batch read: apply `raw_func` to the raw data of each of `runs` (every run if None).
+
+        Only one raw DataFrame is alive at a time, and only raw_func's results are kept, so memory
+        doesn't grow with the number of runs. Profiled as the 'read_raw' stage if a memory_profiler was given.
+        """
+        if runs is None:
+            runs = self.db_session.query(Run).yield_per(RAW_READ_BATCH_SIZE)
+
+        with self.profile('read_raw'):
+            return [raw_func(run.raw) for run in runs]
+
     def run_exists_in_db(self, run: Run) -> bool:
         """
         How do we identify a unique run?
@@ -213,6 +493,10 @@ class DataWarehouseManager:
 
     @staticmethod
     def generate_hash_from_raw(run_path: Path) -> str:
+        # hashing chunk by chunk gives the same digest as hashing the whole encoded file,
+        # so run_hashes already in the Data Warehouse stay valid
+        md5 = hashlib.md5()
         with open(run_path.as_posix(), 'r') as f:
-            contents = f.read().encode('utf-8')
-        return hashlib.md5(contents).hexdigest()
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), ''):
+                md5.update(chunk.encode('utf-8'))
+        return md5.hexdigest()
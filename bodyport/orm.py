@@ -2,7 +2,7 @@ import json
 from typing import Dict
 
 import pandas as pd
-from sqlalchemy import Column, Integer, String, Date, DateTime, Float
+from sqlalchemy import Column, Integer, String, Date, DateTime, Float, JSON
 from sqlalchemy import create_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import Session
@@ -79,3 +79,54 @@ class Run(Base):
     @property
     def raw(self) -> pd.DataFrame:
         return pd.read_csv(self.raw_path)
+
+
+class SubjectFeatures(Base):
+    """
+    Denormalized per-subject summary of the `run` table, so that cohort questions
+    (e.g. average heartbeat of men vs women, first/last visit) don't have to GROUP BY every run.
+
+    Rows are maintained by `DataWarehouseManager.refresh_subject_features()`,
+    which only recomputes subjects whose runs have changed.
+    """
+
+    __tablename__ = 'subject_features'
+
+    created_at = Column(DateTime)
+    updated_at = Column(DateTime)
+    subject_id = Column(Integer, primary_key=True)
+    # copied over from `subject` so cohort queries need no join
+    sex = Column(String)
+    birth_year = Column(Integer)
+    n_runs = Column(Integer)
+    first_run_date = Column(Date)
+    last_run_date = Column(Date)
+    # not every run has had its avg_bpm computed yet
+    n_runs_with_bpm = Column(Integer)
+    mean_avg_bpm = Column(Float)
+    std_avg_bpm = Column(Float)
+    min_avg_bpm = Column(Float)
+    max_avg_bpm = Column(Float)
+
+    def __repr__(self):
+        return f"SubjectFeatures<subject_id={self.subject_id}, n_runs: {self.n_runs}>"
+
+
+class RunFeature(Base):
+    """
+    Output of a registered per-run feature function (see `bodyport/features.py`).
+
+    Keyed by the run_hash rather than the run id: identical raw files share a result, and a run whose
+    raw data changed gets a new hash, so it is recomputed while unchanged runs are skipped.
+    A row existing here is also the checkpoint that lets an interrupted backfill resume.
+    """
+
+    __tablename__ = 'run_feature'
+
+    created_at = Column(DateTime)
+    run_hash = Column(String, primary_key=True)
+    name = Column(String, primary_key=True)
+    value = Column(JSON)
+
+    def __repr__(self):
+        return f"RunFeature<name={self.name}, run_hash: {self.run_hash}>"
@@ -0,0 +1,87 @@
+import sys
+import tracemalloc
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+import pandas as pd
+from sqlalchemy.orm import Session
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows; peak RSS is then simply not reported
+    resource = None
+
+
+def get_peak_rss() -> Optional[int]:
+    """Peak resident set size of this process so far, in bytes"""
+    if resource is None:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports kilobytes, macOS bytes
+    return peak_rss if sys.platform == 'darwin' else peak_rss * 1024
+
+
+class MemoryProfiler:
+    """
+    Memory profiling mode for the Data Warehouse load path and batch reads.
+
+    Each `stage()` records, via tracemalloc:
+        - traced_peak: the most memory allocated at once during the stage, above what was live when it started
+        - traced_delta: memory still allocated when the stage ended, i.e. retained by it
+        - top_allocations: the source lines that retained the most memory
+    as well as the process' peak RSS and the number of objects held by the SQLAlchemy session.
+    Stages shouldn't be nested, since each one resets tracemalloc's peak.
+
+    Pass one to `DataWarehouseManager(memory_profiler=...)` to profile each stage of `load()`/`aload()`
+    and batch reads of raw data through `map_raw()`:
+
+        dw = DataWarehouseManager(memory_profiler=MemoryProfiler())
+        dw.map_raw(len)
+        dw.memory_profiler.report()
+
+    or wrap any other code with `profiler.stage(name)`.
+    """
+
+    def __init__(self, top_n: int = 5):
+        self.top_n = top_n
+        self.stages: List[Dict] = []
+
+    @contextmanager
+    def stage(self, name: str, session: Optional[Session] = None):
+        started_tracing = not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+
+        # peak since the start of this stage only (python 3.9+, otherwise since tracing started)
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+
+        start_snapshot = tracemalloc.take_snapshot()
+        start_current, _ = tracemalloc.get_traced_memory()
+
+        try:
+            yield
+        finally:
+            end_current, end_peak = tracemalloc.get_traced_memory()
+            end_snapshot = tracemalloc.take_snapshot()
+
+            if started_tracing:
+                tracemalloc.stop()
+
+            top_allocations = end_snapshot.compare_to(start_snapshot, 'lineno')[:self.top_n]
+
+            self.stages.append(dict(
+                stage=name,
+                traced_peak=end_peak - start_current,
+                traced_delta=end_current - start_current,
+                peak_rss=get_peak_rss(),
+                session_objects=len(session.identity_map) if session is not None else None,
+                top_allocations=[str(stat) for stat in top_allocations]
+            ))
+
+    def report(self) -> pd.DataFrame:
+        """One row per profiled stage, in the order they ran"""
+        return pd.DataFrame(self.stages, columns=[
+            'stage', 'traced_peak', 'traced_delta', 'peak_rss', 'session_objects', 'top_allocations'
+        ])
@@ -1,14 +1,22 @@
 #!/usr/bin/env python
 
 """Tests for `bodyport` package."""
+import asyncio
+import shutil
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import pandas as pd
 import pytest
 
 from bodyport.config import (
     EXAMPLE_ECG_DIR_LATEST,
     EXAMPLE_ECG_DIR_NEW
 )
+from bodyport.features import FeatureJobRunner, register_feature
 from bodyport.load import DataWarehouseManager
-from bodyport.orm import Base, Run, Subject
+from bodyport.orm import Base, Run, RunFeature, Subject, SubjectFeatures
+from bodyport.profiling import MemoryProfiler
 from sqlalchemy.orm import Session
 from sqlalchemy import create_engine
 
@@ -115,3 +123,301 @@ def test_incremental_load_data_warehouse(sqlite_memory_db):
     data_warehouse.down()
 
 
+def test_async_load_matches_sequential_load(sqlite_memory_db):
+
+    data_warehouse = DataWarehouseManager(db_conn_string=sqlite_memory_db)
+    data_warehouse.up()
+
+    # small queues and batches so that backpressure and batching are actually exercised
+    asyncio.run(data_warehouse.aload(data_dir=EXAMPLE_ECG_DIR_LATEST, queue_size=2, batch_size=7))
+    initial_run_count = len(data_warehouse.pandas_query('select * from run;'))
+    assert initial_run_count == len(list(EXAMPLE_ECG_DIR_LATEST.glob('*/run_*.csv')))
+
+    subjects = data_warehouse.pandas_query('select * from subject;')
+    assert len(subjects) == 80
+
+    # same reconciliation as the sequential loader: only 3 of the 4 new runs are new, and reloading is a no-op.
+    # parsing can also be handed to a process pool
+    with ProcessPoolExecutor(max_workers=2) as executor:
+        asyncio.run(data_warehouse.aload(data_dir=EXAMPLE_ECG_DIR_NEW, executor=executor, batch_size=2))
+    asyncio.run(data_warehouse.aload(data_dir=EXAMPLE_ECG_DIR_NEW))
+
+    refreshed_runs = data_warehouse.pandas_query('select * from run;')
+    assert len(refreshed_runs) == initial_run_count + 3
+
+    subjects = data_warehouse.pandas_query('select * from subject;')
+    assert len(subjects) == 81
+
+    data_warehouse.down()
+
+
+def test_subject_features_are_refreshed_incrementally(sqlite_memory_db):
+
+    data_warehouse = DataWarehouseManager(db_conn_string=sqlite_memory_db)
+    data_warehouse.up()
+    data_warehouse.load(data_dir=EXAMPLE_ECG_DIR_LATEST)
+
+    runs = data_warehouse.pandas_query('select * from run;')
+    features = data_warehouse.pandas_query('select * from subject_features;').set_index('subject_id')
+    assert len(features) == 80
+    assert (features['n_runs'] == runs.groupby('subject_id').size()).all()
+
+    session = data_warehouse.db_session
+    untouched_at = session.query(SubjectFeatures).get(1).updated_at
+
+    # only subject 80 got new runs (subject 81 is brand new), so only those 2 rows should be rewritten
+    data_warehouse.load(data_dir=EXAMPLE_ECG_DIR_NEW)
+    assert session.query(SubjectFeatures).count() == 81
+    assert session.query(SubjectFeatures).get(1).updated_at == untouched_at
+    assert session.query(SubjectFeatures).get(80).n_runs == len(runs[runs.subject_id == 80]) + 1
+
+    # simulate a feature backfill for subject 1
+    subject_runs = session.query(Run).filter_by(subject_id=1).all()
+    for bpm, run in zip([60.0, 70.0, 80.0, 90.0], subject_runs):
+        run.avg_bpm = bpm
+    session.commit()
+    data_warehouse.refresh_subject_features(subject_ids=[1])
+
+    bpms = pd.Series([run.avg_bpm for run in subject_runs])
+    subject_features = session.query(SubjectFeatures).get(1)
+    assert subject_features.n_runs_with_bpm == bpms.count()
+    assert subject_features.mean_avg_bpm == pytest.approx(bpms.mean())
+    assert subject_features.std_avg_bpm == pytest.approx(bpms.std())
+    assert session.query(SubjectFeatures).get(2).mean_avg_bpm is None
+
+    data_warehouse.down()
+
+
+@register_feature(column='avg_bpm')
+def n_samples(raw, meta):
+    """stand-in for a real heart rate feature: needs a raw read, and returns a numpy.int64, which json can't encode"""
+    return raw.iloc[:, 0].count()
+
+
+def test_feature_job_resumes_and_skips_computed_runs(sqlite_memory_db):
+
+    data_warehouse = DataWarehouseManager(db_conn_string=sqlite_memory_db)
+    data_warehouse.up()
+    data_warehouse.load(data_dir=EXAMPLE_ECG_DIR_LATEST)
+    session = data_warehouse.db_session
+
+    runner = FeatureJobRunner(data_warehouse, max_workers=2, chunk_size=7)
+    n_hashes = session.query(Run.run_hash).distinct().count()
+    assert runner.run('n_samples') == n_hashes
+
+    sample_run = session.query(Run).filter_by(subject_id=1).first()
+    assert sample_run.avg_bpm == len(sample_run.raw)
+    # converted to a plain int on the way out of the worker
+    assert type(session.query(RunFeature).filter_by(run_hash=sample_run.run_hash).one().value) is int
+    assert session.query(SubjectFeatures).get(1).mean_avg_bpm is not None
+
+    # nothing left to do on a second pass
+    assert runner.run('n_samples') == 0
+
+    # simulate a backfill interrupted before subject 1's chunk was checkpointed
+    subject_hashes = [run.run_hash for run in session.query(Run).filter_by(subject_id=1)]
+    session.query(RunFeature).filter(RunFeature.run_hash.in_(subject_hashes)).delete(synchronize_session=False)
+    session.commit()
+    assert runner.run('n_samples') == len(set(subject_hashes))
+
+    # new runs are picked up, already computed ones are not
+    data_warehouse.load(data_dir=EXAMPLE_ECG_DIR_NEW)
+    assert runner.run('n_samples') == session.query(Run.run_hash).distinct().count() - n_hashes
+
+    with pytest.raises(ValueError):
+        runner.run('not_a_feature')
+
+    # features can't overwrite the columns runs are identified and tracked by
+    with pytest.raises(ValueError):
+        register_feature(column='run_hash')(n_samples)
+
+    data_warehouse.down()
+
+
+def make_data_dir(parent_dir, n_subjects):
+    """copy the first n_subjects of the example data into a data dir of its own"""
+    data_dir = parent_dir / f'{n_subjects}_subjects' / 'clinic=test' / 'measurement=ecg' / '2021-01-01'
+    for subject_dir in sorted(EXAMPLE_ECG_DIR_LATEST.glob('subject_*'))[:n_subjects]:
+        shutil.copytree(subject_dir, data_dir / subject_dir.name)
+    return data_dir
+
+
+def profile_load(data_dir, use_asyncio=False):
+    data_warehouse = DataWarehouseManager(db_conn_string='sqlite:///:memory:', memory_profiler=MemoryProfiler())
+    data_warehouse.up()
+
+    if use_asyncio:
+        # a fixed size pool, as the default one keeps starting threads while there's more work to hand out
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            asyncio.run(data_warehouse.aload(data_dir=data_dir, executor=executor, queue_size=4, batch_size=10))
+    else:
+        data_warehouse.load(data_dir=data_dir)
+
+    return data_warehouse
+
+
+def median_traced_peak(report, stage):
+    """
+    tracemalloc peaks are noisy (allocator state, thread scheduling, caches filling up),
+    so stages are repeated and compared on their median peak
+    """
+    return report[report.stage == stage]['traced_peak'].median()
+
+
+def assert_peaks_bounded(peaks):
+    """
+    Peaks measured for 8, 16 and 32 subjects should be about the same.
+
+    Holding on to every run's file, DataFrame or Run object grows the peak with the number of runs,
+    which breaks either the absolute ceiling or the 2x margin between 8 and 32 subjects.
+    """
+    largest_raw_file = max(path.stat().st_size for path in EXAMPLE_ECG_DIR_LATEST.glob('*/run_*.csv'))
+    assert max(peaks.values()) < 20 * largest_raw_file
+    assert max(peaks[16], peaks[32]) < 2 * peaks[8]
+
+
+def test_hashing_does_not_hold_whole_file_in_memory(tmp_path):
+    sample_path = EXAMPLE_ECG_DIR_LATEST / 'subject_01' / 'run_1.csv'
+    large_path = tmp_path / 'run_1.csv'
+    large_path.write_text(sample_path.read_text() * 20)
+
+    tracemalloc.start()
+    DataWarehouseManager.generate_hash_from_raw(large_path)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    assert peak < large_path.stat().st_size / 4
+
+
+@pytest.mark.parametrize('use_asyncio', [False, True])
+def test_load_peak_memory_is_independent_of_number_of_files(tmp_path, use_asyncio):
+    stage = 'aload_pipeline' if use_asyncio else 'update_runs'
+
+    # warm up sqlalchemy's compiled statement caches, which would otherwise count against the first load
+    profile_load(make_data_dir(tmp_path, n_subjects=1), use_asyncio=use_asyncio)
+
+    peaks = {}
+    for n_subjects in [8, 16, 32]:
+        data_dir = make_data_dir(tmp_path, n_subjects=n_subjects)
+        reports = [
+            profile_load(data_dir, use_asyncio=use_asyncio).memory_profiler.report()
+            for _ in range(3)
+        ]
+        peaks[n_subjects] = median_traced_peak(pd.concat(reports), stage)
+
+        # the session shouldn't be holding on to the runs it inserted
+        assert (reports[-1].set_index('stage').loc[stage, 'session_objects']) == 0
+
+    # 4x the files, but the stage that reads them should peak at about the same memory
+    assert_peaks_bounded(peaks)
+
+
+def test_batch_read_peak_memory_is_independent_of_number_of_runs(tmp_path):
+    peaks = {}
+    for n_subjects in [8, 16, 32]:
+        data_warehouse = profile_load(make_data_dir(tmp_path, n_subjects=n_subjects))
+        n_runs = data_warehouse.db_session.query(Run).count()
+
+        for _ in range(3):
+            assert len(data_warehouse.map_raw(len)) == n_runs
+        peaks[n_subjects] = median_traced_peak(data_warehouse.memory_profiler.report(), 'read_raw')
+
+    assert_peaks_bounded(peaks)
+
+
+@pytest.mark.parametrize('use_asyncio', [False, True])
+def test_subject_features_catch_up_after_interrupted_load(tmp_path, use_asyncio):
+    data_dir = make_data_dir(tmp_path, n_subjects=2)
+
+    data_warehouse = DataWarehouseManager(db_conn_string='sqlite:///:memory:')
+    data_warehouse.up()
+
+    def load():
+        if use_asyncio:
+            asyncio.run(data_warehouse.aload(data_dir=data_dir, batch_size=5))
+        else:
+            data_warehouse.load(data_dir=data_dir)
+
+    # a missing header makes the load fail after some runs have already been committed
+    last_run_path = list(data_dir.glob('*/run_*.csv'))[-1]
+    header_path = DataWarehouseManager.get_run_json_path(last_run_path)
+    header = header_path.read_text()
+    header_path.unlink()
+
+    with pytest.raises(FileNotFoundError):
+        load()
+    assert data_warehouse.pandas_query('select * from run;').shape[0] > 0
+
+    header_path.write_text(header)
+    load()
+
+    run_counts = data_warehouse.pandas_query('select * from run;').groupby('subject_id').size()
+    features = data_warehouse.pandas_query('select * from subject_features;').set_index('subject_id')
+    assert len(features) == len(run_counts) == 2
+    assert (features['n_runs'] == run_counts).all()
+
+
+def test_feature_job_copies_stored_results_to_duplicate_runs(tmp_path):
+    data_dir = make_data_dir(tmp_path, n_subjects=1)
+
+    data_warehouse = DataWarehouseManager(db_conn_string='sqlite:///:memory:')
+    data_warehouse.up()
+    data_warehouse.load(data_dir=data_dir)
+    session = data_warehouse.db_session
+
+    runner = FeatureJobRunner(data_warehouse, max_workers=2)
+    runner.run('n_samples')
+
+    # the same raw files filed under another subject are new runs, but their hashes are already computed
+    duplicate_dir = tmp_path / 'duplicate' / 'clinic=test' / 'measurement=ecg' / '2021-01-01'
+    shutil.copytree(data_dir / 'subject_01', duplicate_dir / 'subject_99')
+    data_warehouse.load(data_dir=duplicate_dir)
+
+    assert runner.run('n_samples') == 0
+
+    original_runs = {run.run_hash: run.avg_bpm for run in session.query(Run).filter_by(subject_id=1)}
+    duplicate_runs = session.query(Run).filter_by(subject_id=99).all()
+    assert len(duplicate_runs) == len(original_runs)
+    assert all(run.avg_bpm == original_runs[run.run_hash] for run in duplicate_runs)
+
+    assert session.query(SubjectFeatures).get(99).mean_avg_bpm == \
+        pytest.approx(session.query(SubjectFeatures).get(1).mean_avg_bpm)
+
+
+def test_subject_features_catch_up_with_subjects_created_after_refresh(tmp_path, monkeypatch):
+    data_dir = make_data_dir(tmp_path, n_subjects=2)
+
+    data_warehouse = DataWarehouseManager(db_conn_string='sqlite:///:memory:')
+    data_warehouse.up()
+
+    # the load fails after its runs are committed, but before their subjects are created
+    def fail_update_subjects(timestamp):
+        raise RuntimeError("interrupted")
+
+    monkeypatch.setattr(data_warehouse, 'update_subjects', fail_update_subjects)
+    with pytest.raises(RuntimeError):
+        data_warehouse.load(data_dir=data_dir)
+    monkeypatch.undo()
+
+    # a feature backfill in the meantime writes features without sex/birth_year
+    data_warehouse.refresh_subject_features()
+    session = data_warehouse.db_session
+    assert session.query(SubjectFeatures).get(1).sex is None
+
+    data_warehouse.load(data_dir=data_dir)
+
+    for subject in session.query(Subject):
+        features = session.query(SubjectFeatures).get(subject.id)
+        assert (features.sex, features.birth_year) == (subject.sex, subject.birth_year)
+
+
+def test_load_creates_tables_missing_from_older_warehouses(tmp_path):
+    db_conn_string = f"sqlite:///{tmp_path / 'old_warehouse.db'}"
+    # a warehouse from before subject_features existed
+    Base.metadata.create_all(create_engine(db_conn_string), tables=[Run.__table__, Subject.__table__])
+
+    data_warehouse = DataWarehouseManager(db_conn_string=db_conn_string)
+    data_warehouse.load(data_dir=make_data_dir(tmp_path, n_subjects=1))
+
+    features = data_warehouse.pandas_query('select * from subject_features;')
+    assert list(features['subject_id']) == [1]